@@ -1,45 +1,57 @@
 '''HuggingFace Agents course final project GAIA agent benchmark.'''
 
 # Standard library
-import glob
+import asyncio
+import atexit
+import csv
 import logging
+import logging.handlers
 import os
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
 # Third-party
 import gradio as gr
 import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 # Local/Project
 from functions.agent import create_agent
 
 # --- Constants ---
-from configuration import QUESTIONS, DEFAULT_API_URL, INSTRUCTIONS
+from configuration import QUESTIONS, DEFAULT_API_URL, INSTRUCTIONS_PREFIX, AGENT_CONCURRENCY
 
 # --- Logging Configuration ---
 # Create logs directory if it doesn't exist
 os.makedirs('logs', exist_ok=True)
 
-# Clean up old log files
-def cleanup_old_logs():
-    """Remove old log files from the logs directory."""
-    log_files = glob.glob('logs/*.log')
-    for log_file in log_files:
-        try:
-            os.remove(log_file)
-            print(f"Removed old log file: {log_file}")
-        except OSError as e:
-            print(f"Error removing log file {log_file}: {e}")
-
-# Clean up old logs before starting
-cleanup_old_logs()
+# Log record format shared by all handlers
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Rotate the log file once it gets large, keeping the last few files. Buffer
+# records in memory and write them out in batches, flushing straight away on
+# errors and at shutdown
+file_handler = logging.handlers.RotatingFileHandler(
+    'logs/agent.log',
+    maxBytes=10_000_000,
+    backupCount=3,
+    encoding='utf-8'
+)
+file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+memory_handler = logging.handlers.MemoryHandler(
+    capacity=1024,
+    flushLevel=logging.ERROR,
+    target=file_handler
+)
+atexit.register(memory_handler.close)
 
 # Configure root logger
 logging.basicConfig(
     level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format=LOG_FORMAT,
     handlers=[
-        logging.FileHandler('logs/agent.log', encoding='utf-8'),
+        memory_handler,
         logging.StreamHandler()  # Also log to console
     ]
 )
@@ -47,6 +59,64 @@ logging.basicConfig(
 # Get logger for this module
 logger = logging.getLogger(__name__)
 
+# --- HTTP Session ---
+# Shared keep-alive connection pool for the scoring API, retries transient server errors
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504))
+))
+SESSION.headers.update({'User-Agent': 'gaia-agent/1.0', 'Accept-Encoding': 'gzip'})
+
+# --- Agents ---
+# Built once at import and reused by every run, one agent per concurrent question.
+# Agents reset their memory at the start of each run, so they are safe to reuse.
+try:
+    AGENTS = [create_agent() for _ in range(AGENT_CONCURRENCY)]
+    AGENT_INIT_ERROR = None
+
+except Exception as e: # pylint: disable=W0703
+    logger.error("Error instantiating agent: %s", e)
+    AGENTS = []
+    AGENT_INIT_ERROR = e
+
+
+def write_results_csv(results_log: list, filename: str = 'results.csv') -> None:
+    """Writes the results log to a CSV file."""
+
+    with open(filename, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=['Task ID', 'Question', 'Submitted Answer'])
+        writer.writeheader()
+        writer.writerows(results_log)
+
+
+async def run_agents(agents: list, questions: list) -> list:
+    """
+    Runs the agents on the questions concurrently, at most one question per agent
+    at a time. Returns the answers in question order, with any exception raised
+    by an agent in place of its answer.
+    """
+
+    semaphore = asyncio.Semaphore(len(agents))
+
+    async def _run_one(question_text: str) -> str:
+        async with semaphore:
+
+            # The semaphore guarantees there is an idle agent to take
+            agent = agents.pop()
+
+            try:
+                # smolagents is synchronous, so run the agent in a worker thread
+                return await asyncio.to_thread(agent.run, INSTRUCTIONS_PREFIX + question_text)
+
+            finally:
+                agents.append(agent)
+
+    tasks = [_run_one(question_text) for question_text in questions]
+
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
 
 def run_and_submit_all(profile: gr.OAuthProfile | None):
     """
@@ -67,12 +137,9 @@ def run_and_submit_all(profile: gr.OAuthProfile | None):
     questions_url = f'{api_url}/questions'
     submit_url = f'{api_url}/submit'
 
-    # 1. Instantiate Agent (imported from agent.py)
-    try:
-        agent = create_agent()
-    except Exception as e: # pylint: disable=W0703
-        logger.error("Error instantiating agent: %s", e)
-        return f"Error initializing agent: {e}", None
+    # 1. Check Agents (instantiated at import from agent.py)
+    if not AGENTS:
+        return f"Error initializing agent: {AGENT_INIT_ERROR}", None
 
     # In the case of an app running as a hugging Face space, this link points toward your
     # codebase (useful for others so please keep it public)
@@ -83,8 +150,13 @@ def run_and_submit_all(profile: gr.OAuthProfile | None):
     logger.info('Fetching questions from: %s', questions_url)
 
     try:
-        response = requests.get(questions_url, timeout=15)
+        response = SESSION.get(questions_url, timeout=15)
         response.raise_for_status()
+
+        # Save the fetched questions to a file for debugging purposes
+        with open('questions.json', 'wb') as f:
+            f.write(response.content)
+
         questions_data = response.json()
 
         if not questions_data:
@@ -106,44 +178,67 @@ def run_and_submit_all(profile: gr.OAuthProfile | None):
         logger.error('An unexpected error occurred fetching questions: %s', e)
         return f'An unexpected error occurred fetching questions: {e}', None
 
-    with open('questions.json', 'w', encoding='utf-8') as f:
-        # Save the fetched questions to a file for debugging purposes
-        pd.DataFrame(questions_data).to_json(f, orient='records', lines=True, force_ascii=False)
-
     # 3. Run your Agent
-    results_log = []
-    answers_payload = []
+    # Select the configured questions (one-based), ignoring any out of range
+    selected = [
+        questions_data[question_number - 1]
+        for question_number in QUESTIONS
+        if 0 < question_number <= len(questions_data)
+    ]
 
-    logger.info('Running agent on %d questions...', len(questions_data))
+    out_of_range = [
+        question_number for question_number in QUESTIONS
+        if not 0 < question_number <= len(questions_data)
+    ]
 
-    for question_number in QUESTIONS:
-        item = questions_data[question_number - 1]  # Adjust for zero-based index
-        task_id = item.get("task_id")
-        question_text = item.get("question")
+    if out_of_range:
+        logger.warning(
+            'Skipping question numbers out of range (1-%d): %s',
+            len(questions_data),
+            out_of_range
+        )
 
-        if not task_id or question_text is None:
-            logger.warning('Skipping item with missing task_id or question: %s', item)
-            continue
+    # Keep the items that have both a task ID and question text
+    questions = [
+        (item.get("task_id"), item.get("question"))
+        for item in selected
+        if item.get("task_id") and item.get("question") is not None
+    ]
 
-        try:
-            submitted_answer = agent.run(
-                INSTRUCTIONS + '\n' + question_text
-            )
-
-            answers_payload.append({"task_id": task_id, "submitted_answer": submitted_answer})
-            results_log.append({
-                "Task ID": task_id,
-                "Question": question_text,
-                "Submitted Answer": submitted_answer
-            })
-
-        except Exception as e: # pylint: disable=W0703
-            logger.error('Error running agent on task %s: %s', task_id, e)
-            results_log.append({
+    skipped = len(selected) - len(questions)
+
+    if skipped:
+        logger.warning('Skipping %d items with missing task_id or question.', skipped)
+
+    logger.info(
+        'Running agent on %d questions, %d at a time...',
+        len(questions),
+        len(AGENTS)
+    )
+
+    answers = asyncio.run(run_agents(AGENTS, [question_text for _, question_text in questions]))
+
+    # Every question gets a results row, in question order
+    results_log = [None] * len(questions)
+    answers_payload = []
+
+    for i, ((task_id, question_text), submitted_answer) in enumerate(zip(questions, answers)):
+
+        if isinstance(submitted_answer, Exception):
+            logger.error('Error running agent on task %s: %s', task_id, submitted_answer)
+            results_log[i] = {
                  "Task ID": task_id,
                  "Question": question_text,
-                 "Submitted Answer": f"AGENT ERROR: {e}"
-             })
+                 "Submitted Answer": f"AGENT ERROR: {submitted_answer}"
+             }
+            continue
+
+        answers_payload.append({"task_id": task_id, "submitted_answer": submitted_answer})
+        results_log[i] = {
+            "Task ID": task_id,
+            "Question": question_text,
+            "Submitted Answer": submitted_answer
+        }
 
     if not answers_payload:
         logger.warning('Agent did not produce any answers to submit.')
@@ -162,11 +257,18 @@ def run_and_submit_all(profile: gr.OAuthProfile | None):
 
     # 5. Submit
     logger.info('Submitting %d answers to: %s', len(answers_payload), submit_url)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        submission = executor.submit(SESSION.post, submit_url, json=submission_data, timeout=60)
+
+        # Save and tabulate the results while the submission is in flight
+        write_results_csv(results_log)
+        results_df = pd.DataFrame(results_log)
+
     try:
-        response = requests.post(submit_url, json=submission_data, timeout=60)
+        response = submission.result()
         response.raise_for_status()
         result_data = response.json()
-        final_status = (
+        status_message = (
             f"Submission Successful!\n"
             f"User: {result_data.get('username')}\n"
             f"Overall Score: {result_data.get('score', 'N/A')}% "
@@ -175,9 +277,6 @@ def run_and_submit_all(profile: gr.OAuthProfile | None):
             f"Message: {result_data.get('message', 'No message received.')}"
         )
         logger.info('Submission successful.')
-        results_df = pd.DataFrame(results_log)
-        results_df.to_csv('results.csv', index=False)
-        return final_status, results_df
 
     except requests.exceptions.HTTPError as e:
         error_detail = f"Server responded with status {e.response.status_code}."
@@ -191,30 +290,20 @@ def run_and_submit_all(profile: gr.OAuthProfile | None):
 
         status_message = f"Submission Failed: {error_detail}"
         logger.error(status_message)
-        results_df = pd.DataFrame(results_log)
-        results_df.to_csv('results.csv', index=False)
-        return status_message, results_df
 
     except requests.exceptions.Timeout:
         status_message = "Submission Failed: The request timed out."
         logger.error(status_message)
-        results_df = pd.DataFrame(results_log)
-        results_df.to_csv('results.csv', index=False)
-        return status_message, results_df
 
     except requests.exceptions.RequestException as e:
         status_message = f"Submission Failed: Network error - {e}"
         logger.error(status_message)
-        results_df = pd.DataFrame(results_log)
-        results_df.to_csv('results.csv', index=False)
-        return status_message, results_df
 
     except Exception as e: # pylint: disable=W0703
         status_message = f"An unexpected error occurred during submission: {e}"
         logger.error(status_message)
-        results_df = pd.DataFrame(results_log)
-        results_df.to_csv('results.csv', index=False)
-        return status_message, results_df
+
+    return status_message, results_df
 
 
 # --- Build Gradio Interface using Blocks ---
@@ -1,5 +1,6 @@
 """Configuration constants for the GAIA agent project."""
 
+import os
 from smolagents import OpenAIServerModel, InferenceClientModel
 
 # pylint: disable=line-too-long
@@ -7,6 +8,9 @@ from smolagents import OpenAIServerModel, InferenceClientModel
 # Which questions to answer
 QUESTIONS = [1,3,5,8,9,11,13,17,18,20]
 
+# How many questions to work on at once, each concurrent question gets its own agent
+AGENT_CONCURRENCY = int(os.getenv('AGENT_CONCURRENCY', '4'))
+
 # GAIA benchmark scoring API
 DEFAULT_API_URL = 'https://agents-course-unit4-scoring.hf.space'
 
@@ -15,6 +19,9 @@ INSTRUCTIONS = """
 You are a general AI assistant. I will ask you a question. Your final answer should be a number OR as few words as possible OR a comma separated list of numbers and/or strings. If you are asked for a number, don't use comma to write your number neither use units such as $ or percent sign unless specified otherwise. If you are asked for a string, don't use articles, neither abbreviations (e.g. for cities), and write the digits in plain text unless specified otherwise. If you are asked for a comma separated list, apply the above rules depending of whether the element to be put in the list is a number or a string. Submit the final answer via the final_answer tool.
 """
 
+# Instructions ready to have the question text appended
+INSTRUCTIONS_PREFIX = INSTRUCTIONS.rstrip() + '\n'
+
 # Agent model definitions
 MANAGER_MODEL = InferenceClientModel(
     "deepseek-ai/DeepSeek-V3",
@@ -40,4 +47,9 @@ MODEL = OpenAIServerModel(
 )
 
 TOKEN_LIMITER = 5000
-STEP_WAIT = 60
+# Model token budget per minute, shared by all agents. Steps only wait once it runs out
+TOKENS_PER_MINUTE = int(os.getenv('TOKENS_PER_MINUTE', '30000'))
+
+# Longest text part of a message sent for summarization, longer parts keep their
+# start and end only
+SUMMARY_PART_CHARS = 2000
@@ -9,6 +9,7 @@ from smolagents import CodeAgent, VisitWebpageTool
 from functions.tools import (
     google_search,
     wikipedia_search,
+    wikipedia_searches,
     get_wikipedia_page,
     libretext_book_search,
     get_libretext_book
@@ -20,6 +21,9 @@ from configuration import MODEL
 # Get logger for this module
 logger = logging.getLogger(__name__)
 
+# Tool instances are stateless between calls, so all agents share one of each
+VISIT_WEBPAGE_TOOL = VisitWebpageTool()
+
 def create_agent():
     '''Creates agent for GAIA question answering system.'''
 
@@ -74,8 +78,9 @@ def create_agent():
         model=MODEL,
         tools=[
             google_search,
-            VisitWebpageTool(),
+            VISIT_WEBPAGE_TOOL,
             wikipedia_search,
+            wikipedia_searches,
             get_wikipedia_page,
             libretext_book_search,
             get_libretext_book
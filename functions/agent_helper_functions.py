@@ -4,13 +4,41 @@ import os
 import time
 import json
 import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
 from smolagents import CodeAgent, ActionStep, MessageRole
-from configuration import CHECK_MODEL, TOKEN_LIMITER, STEP_WAIT
+from configuration import (
+    AGENT_CONCURRENCY,
+    CHECK_MODEL,
+    TOKEN_LIMITER,
+    TOKENS_PER_MINUTE,
+    SUMMARY_PART_CHARS
+)
 
 # Get logger for this module
 logger = logging.getLogger(__name__)
 
+# Summarization client and model ID, set up on first use by summarize_old_messages()
+_SUMMARIZER_CLIENT = None
+_SUMMARIZER_MODEL_ID = None
+
+# Summarization runs in the background so agent steps don't wait on it, with a worker
+# per concurrent agent so one agent's summary doesn't hold up another's. Pending
+# summaries are kept per agent as (future, system message) until they are applied.
+_SUMMARY_POOL = ThreadPoolExecutor(max_workers=AGENT_CONCURRENCY)
+_PENDING_SUMMARIES = weakref.WeakKeyDictionary()
+
+# The summary is updated incrementally. Per agent, keep the latest summary, the last
+# step number it covers and any trimmed steps it doesn't cover yet.
+_ROLLING_SUMMARIES = weakref.WeakKeyDictionary()
+_SUMMARIZED_UP_TO = weakref.WeakKeyDictionary()
+_UNSUMMARIZED_STEPS = weakref.WeakKeyDictionary()
+
+# Upper limit on how long a summarization request can run, in seconds
+SUMMARY_TIMEOUT = 30
+
 
 def check_reasoning(final_answer:str, agent_memory):
     """Checks the reasoning and plot of the agent's final answer."""
@@ -48,75 +76,232 @@ def check_reasoning(final_answer:str, agent_memory):
 def step_memory_cap(memory_step: ActionStep, agent: CodeAgent) -> None:
     '''Removes old steps from agent memory to keep context length under control.'''
 
-    task_step = agent.memory.steps[0]
-    planning_step = agent.memory.steps[1]
-    latest_step = agent.memory.steps[-1]
+    # Forget any summary state left over from the agent's previous run
+    if memory_step.step_number == 1:
+        for state in (
+            _PENDING_SUMMARIES,
+            _ROLLING_SUMMARIES,
+            _SUMMARIZED_UP_TO,
+            _UNSUMMARIZED_STEPS
+        ):
+            state.pop(agent, None)
+
+    # Swap in the background summary once it is ready
+    if agent in _PENDING_SUMMARIES and _PENDING_SUMMARIES[agent][0].done():
+        summary_future, system_message = _PENDING_SUMMARIES.pop(agent)
+        summary = summary_future.result()
+
+        if summary is None:
+            # The update failed, so start the next summary over from the full context
+            _ROLLING_SUMMARIES.pop(agent, None)
+            _SUMMARIZED_UP_TO.pop(agent, None)
+
+        else:
+            _ROLLING_SUMMARIES[agent] = summary
+
+        if _apply_summary(agent, system_message, summary):
+            return
+
+    token_usage = agent.memory.steps[-1].token_usage.total_tokens
 
-    if len(agent.memory.steps) > 2:
-        agent.memory.steps = [task_step, planning_step, latest_step]
+    # Nothing to trim or summarize
+    if token_usage <= TOKEN_LIMITER and len(agent.memory.steps) <= 3:
+        return
+
+    # Keep the task, planning and latest steps, dropping the ones in between in place.
+    # Hold on to any turns the summary doesn't cover yet for its next update.
+    summarized_up_to = _SUMMARIZED_UP_TO.get(agent, 0)
+
+    for step in agent.memory.steps[2:-1]:
+
+        # Each step's model input is a copy of the whole context at the time, drop it
+        # straight away. Summaries are built from the step's own turns, not its input.
+        step.model_input_messages = None
+
+        if isinstance(step, ActionStep) and step.step_number > summarized_up_to:
+            _UNSUMMARIZED_STEPS.setdefault(agent, []).append(step)
+
+    del agent.memory.steps[2:-1]
 
     logger.info('Agent memory has %d steps', len(agent.memory.steps))
     logger.info('Latest step is step %d', memory_step.step_number)
     logger.info('Contains: %s messages', len(agent.memory.steps[-1].model_input_messages))
-    logger.info('Token usage: %s', agent.memory.steps[-1].token_usage.total_tokens)
+    logger.info('Token usage: %s', token_usage)
 
-    for message in agent.memory.steps[-1].model_input_messages:
-        logger.debug(' Role: %s: %s', message['role'], message['content'][:100])
+    if logger.isEnabledFor(logging.DEBUG):
+        for message in agent.memory.steps[-1].model_input_messages:
+            logger.debug(' Role: %s: %s', message['role'], _short_content(message['content']))
 
-    token_usage = agent.memory.steps[-1].token_usage.total_tokens
-
-    if token_usage > TOKEN_LIMITER:
-        logger.info('Token usage is %d, summarizing old messages', token_usage)
+    latest_step = agent.memory.steps[-1]
 
-        summary = summarize_old_messages(
-            agent.memory.steps[-1].model_input_messages[1:]
+    # Callbacks run before the current step joins memory, so on planning steps the
+    # latest step is the plan. Wait for the next action step to summarize from.
+    if (
+        token_usage > TOKEN_LIMITER and
+        agent not in _PENDING_SUMMARIES and
+        isinstance(latest_step, ActionStep)
+    ):
+        logger.info('Token usage is %d, summarizing old messages in the background', token_usage)
+
+        previous_summary = _ROLLING_SUMMARIES.get(agent)
+        new_steps = _UNSUMMARIZED_STEPS.pop(agent, [])
+
+        # Send only the turns since the last summary, or the whole context the first time.
+        # The first time, also send the steps trimmed before the latest step's context
+        # was built, the ones still in it are already sent as part of it.
+        if previous_summary is None:
+            context = latest_step.model_input_messages[1:]
+            new_messages = []
+
+            for step in new_steps:
+                step_messages = step.to_messages()
+
+                if not all(message in context for message in step_messages):
+                    new_messages.extend(step_messages)
+
+            new_messages += context + latest_step.to_messages()
+
+        else:
+            new_steps.extend(
+                step for step in agent.memory.steps[1:]
+                if isinstance(step, ActionStep) and step.step_number > summarized_up_to
+            )
+            new_steps.sort(key=lambda step: step.step_number)
+            new_messages = [message for step in new_steps for message in step.to_messages()]
+
+        _SUMMARIZED_UP_TO[agent] = latest_step.step_number
+
+        _PENDING_SUMMARIES[agent] = (
+            _SUMMARY_POOL.submit(
+                summarize_old_messages,
+                _compact_messages(new_messages),
+                previous_summary
+            ),
+            latest_step.model_input_messages[0]
         )
 
-        if summary is not None:
 
-            new_messages = [agent.memory.steps[-1].model_input_messages[0]]
-            new_messages.append({
-                'role': MessageRole.USER,
-                'content': [{
-                    'type': 'text',
-                    'text': f'Here is a summary of your investigation so far: {summary}'
-                }]
-            })
-            agent.memory.steps = [agent.memory.steps[0]]
-            agent.memory.steps[0].model_input_messages = new_messages
+def _apply_summary(agent: CodeAgent, system_message: dict, summary: str) -> bool:
+    '''Replaces old agent memory with the system message followed by the summary,
+    keeping the latest step. Returns True if memory was replaced.'''
+
+    if summary is None:
+        return False
+
+    new_messages = [system_message]
+    new_messages.append({
+        'role': MessageRole.USER,
+        'content': [{
+            'type': 'text',
+            'text': f'Here is a summary of your investigation so far: {summary}'
+        }]
+    })
 
+    # Steps taken while the summary was being written aren't in it, hold on to
+    # them for the next update
+    summarized_up_to = _SUMMARIZED_UP_TO.get(agent, 0)
+
+    for step in agent.memory.steps[1:-1]:
+        step.model_input_messages = None
+
+        if isinstance(step, ActionStep) and step.step_number > summarized_up_to:
+            _UNSUMMARIZED_STEPS.setdefault(agent, []).append(step)
+
+    agent.memory.steps = [agent.memory.steps[0], agent.memory.steps[-1]]
+    agent.memory.steps[0].model_input_messages = new_messages
+
+    if logger.isEnabledFor(logging.DEBUG):
         for message in agent.memory.steps[0].model_input_messages:
-            logger.debug(' Role: %s: %s', message['role'], message['content'][:100])
+            logger.debug(' Role: %s: %s', message['role'], _short_content(message['content']))
 
+    return True
 
-def summarize_old_messages(messages: dict) -> dict:
-    '''Summarizes old messages to keep context length under control.'''
 
-    client = OpenAI(api_key=os.environ['MODAL_API_KEY'])
+def _compact_messages(messages: list, max_length: int = SUMMARY_PART_CHARS) -> list:
+    '''Returns copies of the messages with long text cut down to its start and end.
+    Long tool observations (web pages, search results) make up most of the tokens
+    sent for summarization, but rarely need to be read in full to summarize them.'''
 
-    client.base_url = (
-        'https://gperdrizet--vllm-openai-compatible-summarization-serve.modal.run/v1'
-    )
+    compacted = []
 
-    # Default to first avalible model
-    model = client.models.list().data[0]
-    model_id = model.id
+    for message in messages:
+        content = message['content']
 
-    messages = [
-        {
-            'role': 'system',
-            'content': ('Summarize the following interaction between an AI agent and a user.' +
-                f'Return the summary formatted as text, not as JSON: {json.dumps(messages)}')
-        }
-    ]
+        if isinstance(content, str):
+            content = _compact_text(content, max_length)
+
+        elif isinstance(content, list):
+            content = [
+                {**part, 'text': _compact_text(part['text'], max_length)}
+                if part.get('type') == 'text' and isinstance(part.get('text'), str) else part
+                for part in content
+            ]
+
+        compacted.append({**message, 'content': content})
+
+    return compacted
+
+
+def _compact_text(text: str, max_length: int) -> str:
+    '''Keeps the start and end of text longer than max_length.'''
+
+    if len(text) <= max_length:
+        return text
+
+    half = max_length // 2
+
+    return f'{text[:half]}\n[... {len(text) - 2 * half} characters omitted ...]\n{text[-half:]}'
+
+
+def _short_content(content, max_length: int = 200) -> str:
+    '''Returns a short string preview of message content for logging, content
+    can be a string or a list of multimodal content parts.'''
+
+    if not isinstance(content, str):
+        content = json.dumps(content, default=str)
+
+    return content[:max_length]
+
+
+def summarize_old_messages(messages: list, previous_summary: str = None) -> str:
+    '''Summarizes old messages to keep context length under control. If there is a
+    previous summary, it is updated with the new messages instead.'''
+
+    global _SUMMARIZER_CLIENT, _SUMMARIZER_MODEL_ID # pylint: disable=global-statement
+
+    # Create the client and look up the model on first use only
+    if _SUMMARIZER_CLIENT is None:
+        client = OpenAI(api_key=os.environ['MODAL_API_KEY'])
+
+        client.base_url = (
+            'https://gperdrizet--vllm-openai-compatible-summarization-serve.modal.run/v1'
+        )
+
+        # Default to first avalible model
+        _SUMMARIZER_MODEL_ID = client.models.list().data[0].id
+        _SUMMARIZER_CLIENT = client
+
+    if previous_summary is None:
+        prompt = 'Summarize the following interaction between an AI agent and a user.'
+
+    else:
+        prompt = ('Here is a running summary of an interaction between an AI agent and a user: ' +
+            previous_summary + '\n\nUpdate the summary with the new turns of the interaction ' +
+            'that follow.')
+
+    messages = [{'role': 'system', 'content': prompt}] + _as_chat_messages(
+        messages +
+        [{'role': 'user', 'content': 'Now return the summary formatted as text, not as JSON.'}]
+    )
 
     completion_args = {
-        'model': model_id,
+        'model': _SUMMARIZER_MODEL_ID,
         'messages': messages,
+        'timeout': SUMMARY_TIMEOUT,
     }
 
     try:
-        response = client.chat.completions.create(**completion_args)
+        response = _SUMMARIZER_CLIENT.chat.completions.create(**completion_args)
 
     except Exception as e: # pylint: disable=broad-exception-caught
         response = None
@@ -130,13 +315,93 @@ def summarize_old_messages(messages: dict) -> dict:
 
     return summary
 
+
+def _as_chat_messages(messages: list) -> list:
+    '''Converts agent memory messages to plain chat messages for the summarizer. Tool
+    calls become assistant messages and tool responses user messages, content is
+    flattened to its text and consecutive messages from the same role are merged.'''
+
+    roles = {
+        MessageRole.SYSTEM: 'system',
+        MessageRole.USER: 'user',
+        MessageRole.ASSISTANT: 'assistant',
+        MessageRole.TOOL_CALL: 'assistant',
+        MessageRole.TOOL_RESPONSE: 'user',
+    }
+
+    chat_messages = []
+
+    for message in messages:
+        role = roles[MessageRole(message['role'])]
+
+        content = message['content']
+
+        if isinstance(content, list):
+            content = '\n'.join(
+                part['text'] for part in content
+                if part.get('type') == 'text' and isinstance(part.get('text'), str)
+            )
+
+        if not content:
+            continue
+
+        if chat_messages and chat_messages[-1]['role'] == role:
+            chat_messages[-1]['content'] += '\n\n' + content
+
+        else:
+            chat_messages.append({'role': role, 'content': content})
+
+    return chat_messages
+
+
+class _TokenBucket:
+    '''Token bucket rate limiter, refills continuously at rate tokens per second
+    up to capacity. Thread-safe, so one bucket can be shared by concurrent agents.'''
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def acquire(self, tokens: float) -> float:
+        '''Takes tokens from the bucket, waiting until they have been refilled if
+        the bucket is short. Returns the time waited in seconds.'''
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # Take the tokens now, the bucket runs into debt until they are refilled
+            self.tokens -= tokens
+            wait = max(0.0, -self.tokens / self.rate)
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+
+_TOKEN_BUCKET = _TokenBucket(rate=TOKENS_PER_MINUTE / 60, capacity=TOKENS_PER_MINUTE)
+
+
 def step_wait(memory_step: ActionStep, agent: CodeAgent) -> None:
-    '''Waits for a while to prevent hitting API rate limits.'''
+    '''Waits, if needed, to keep model token usage under the rate limit.'''
+
+    if memory_step.token_usage is not None:
+        step_tokens = memory_step.token_usage.total_tokens
+
+    else:
+        step_tokens = 0
 
-    logger.info('Waiting for %d seconds to prevent hitting API rate limits', STEP_WAIT)
-    logger.info('Current step is %d', memory_step.step_number)
-    logger.info('Current agent has %d steps', len(agent.memory.steps))
+    wait = _TOKEN_BUCKET.acquire(step_tokens)
 
-    time.sleep(STEP_WAIT)
+    if wait > 0:
+        logger.info('Waited %.1f seconds to prevent hitting API rate limits', wait)
+        logger.info('Current step is %d', memory_step.step_number)
+        logger.info('Current agent has %d steps', len(agent.memory.steps))
 
     return True
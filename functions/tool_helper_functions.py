@@ -1,15 +1,140 @@
 '''Helper functions for GAIA question answering agent tools.'''
 
+import os
+import re
 import requests
 import time
 import logging
-import bleach
-from bs4 import BeautifulSoup
-from bleach.css_sanitizer import CSSSanitizer
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from types import MappingProxyType
+import nh3
+import requests_cache
+import lxml.html
+from lxml import etree
+from selectolax.lexbor import LexborHTMLParser
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 # Get logger for this module
 logger = logging.getLogger(__name__)
 
+# Shared keep-alive connection pool for all page fetches and API calls made by the
+# tools, so repeat calls to the same host skip the TCP and TLS handshakes. Retries
+# failed connections. Successful responses are cached on disk for a day, so pages
+# fetched again, even by a later run, don't go back to the network. Servers' own
+# Cache-Control headers are ignored on purpose. MediaWiki pages usually come with
+# max-age=0 and must-revalidate, which would skip the cache or revalidate every fetch.
+SESSION = requests_cache.CachedSession(
+    '.http_cache',
+    backend='sqlite',
+    expire_after=timedelta(hours=24),
+    allowable_codes=(200,)
+)
+_ADAPTER = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.3)
+)
+SESSION.mount('https://', _ADAPTER)
+SESSION.mount('http://', _ADAPTER)
+
+# Headers to mimic a real browser. Read-only, as the one mapping is shared by every
+# request. Passed per request rather than set on the session, because Wikipedia
+# fetches share the session too.
+_BROWSER_HEADERS = MappingProxyType({
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36' +
+        '(KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    # Includes Brotli when it is installed, so only what can be decoded is asked for
+    'Accept-Encoding': requests.utils.DEFAULT_ACCEPT_ENCODING,
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+})
+
+
+def _has_class(class_name: str) -> str:
+    '''Returns an XPath predicate matching elements with class_name among their classes.'''
+
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')"
+
+
+# Compiled XPath queries for the LibreTexts table of contents pages. Book pages list
+# chapters as li.mt-sortable-listing elements, chapter pages list sections as
+# li.mt-list-topics elements. Each query after the first runs relative to one listing.
+_BOOK_LISTINGS = etree.XPath(f"//li[{_has_class('mt-sortable-listing')}]")
+_BOOK_LINK = etree.XPath(f"(.//a[{_has_class('mt-sortable-listing-link')}])[1]")
+_BOOK_TITLE = etree.XPath(f"(.//span[{_has_class('mt-sortable-listing-title')}])[1]")
+
+_CHAPTER_LISTINGS = etree.XPath(f"//li[{_has_class('mt-list-topics')}]")
+_CHAPTER_DETAILS = etree.XPath(f"(.//dl[{_has_class('mt-listing-detailed')}])[1]")
+_CHAPTER_TITLE = etree.XPath(f"(.//dt[{_has_class('mt-listing-detailed-title')}])[1]")
+_CHAPTER_OVERVIEW = etree.XPath(f"(.//dd[{_has_class('mt-listing-detailed-overview')}])[1]")
+_FIRST_LINK = etree.XPath("(.//a)[1]")
+
+
+# Largest LibreTexts page that will be parsed, in bytes. Pages over it are
+# refused rather than risk the parser running out of memory.
+MAX_LIBRETEXTS_PAGE_BYTES = 8 * 1024 * 1024
+
+
+def _parse_html(content: bytes):
+    '''Parses an HTML page body into an lxml document. LibreTexts serves UTF-8, but
+    doesn't always say so in the page, so the encoding is set explicitly.'''
+
+    return lxml.html.fromstring(content, parser=lxml.html.HTMLParser(encoding='utf-8'))
+
+
+# Serper Google search JSON API, used by google_search when SERPER_API_KEY is set
+SERPER_SEARCH_URL = 'https://google.serper.dev/search'
+
+
+def serper_search(query: str, num_results: int = 10) -> list:
+    """
+    Run a Google search through the Serper API and return the top results.
+
+    Args:
+        query (str): The search query.
+        num_results (int, optional): The number of results to return.
+
+    Returns:
+        list: The search results in the following format, or an error dictionary.
+        [{'title': str, 'url': str, 'description': str}, ...]
+    """
+
+    logger.info('Searching Google via Serper: %s', query)
+
+    try:
+        response = SESSION.post(
+            SERPER_SEARCH_URL,
+            headers={'X-API-KEY': os.environ['SERPER_API_KEY']},
+            json={'q': query, 'num': num_results},
+            timeout=10
+        )
+        response.raise_for_status()
+
+        results = response.json().get('organic', [])[:num_results]
+
+        return [
+            {
+                'title': result.get('title', ''),
+                'url': result.get('link', ''),
+                'description': result.get('snippet', '')
+            }
+            for result in results
+        ]
+
+    except requests.exceptions.RequestException as e:
+        logger.error('Request error while searching Google: %s', str(e))
+
+        return {'error': f'Request error: {str(e)}'}
+
+    except Exception as e: # pylint:disable=broad-exception-caught
+        logger.error('Unexpected error in Google search: %s', str(e))
+
+        return {'error': f'Unexpected error: {str(e)}'}
+
 
 def libretext_book_parser(url: str) -> dict:
     """
@@ -25,28 +150,22 @@ def libretext_book_parser(url: str) -> dict:
 
     logger.info('Parsing LibreTexts book: %s', url)
 
-    # Set up headers to mimic a real browser
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36' +
-            '(KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.5',
-        'Accept-Encoding': 'gzip, deflate',
-        'Connection': 'keep-alive',
-        'Upgrade-Insecure-Requests': '1',
-    }
-
     try:
         # Fetch the book page
-        response = requests.get(url, headers=headers, timeout=15)
+        response = SESSION.get(url, headers=_BROWSER_HEADERS, timeout=15)
         response.raise_for_status()
 
+        if len(response.content) > MAX_LIBRETEXTS_PAGE_BYTES:
+            logger.error('Book page too large: %d bytes', len(response.content))
+
+            return {'error': 'Page too large.'}
+
         # Parse the HTML content
-        soup = BeautifulSoup(response.content, 'html.parser')
+        document = _parse_html(response.content)
 
         # Look for the table of contents structure
         # LibreTexts books typically use li elements with class 'mt-sortable-listing'
-        chapter_listings = soup.find_all('li', class_='mt-sortable-listing')
+        chapter_listings = _BOOK_LISTINGS(document)
 
         logger.info('Found %d potential chapter listings', len(chapter_listings))
 
@@ -56,13 +175,14 @@ def libretext_book_parser(url: str) -> dict:
         for listing in chapter_listings:
 
             # Extract the link element
-            link = listing.find('a', class_='mt-sortable-listing-link')
+            link = _BOOK_LINK(listing)
 
             if link:
+                link = link[0]
 
                 # Extract title from the span with class 'mt-sortable-listing-title'
-                title_span = link.find('span', class_='mt-sortable-listing-title')
-                title = title_span.get_text(strip=True) if title_span else ''
+                title_span = _BOOK_TITLE(link)
+                title = title_span[0].text_content().strip() if title_span else ''
 
                 # Extract URL from href attribute
                 chapter_url = link.get('href', '')
@@ -119,28 +239,22 @@ def libretext_chapter_parser(url: str) -> dict:
 
     logger.info('Parsing LibreTexts chapter: %s', url)
 
-    # Set up headers to mimic a real browser
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36' +
-            '(KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.5',
-        'Accept-Encoding': 'gzip, deflate',
-        'Connection': 'keep-alive',
-        'Upgrade-Insecure-Requests': '1',
-    }
-
     try:
         # Fetch the chapter page
-        response = requests.get(url, headers=headers, timeout=15)
+        response = SESSION.get(url, headers=_BROWSER_HEADERS, timeout=15)
         response.raise_for_status()
 
+        if len(response.content) > MAX_LIBRETEXTS_PAGE_BYTES:
+            logger.error('Chapter page too large: %d bytes', len(response.content))
+
+            return {'error': 'Page too large.'}
+
         # Parse the HTML content
-        soup = BeautifulSoup(response.content, 'html.parser')
+        document = _parse_html(response.content)
 
         # Look for the section structure
         # LibreTexts chapters typically use li elements with class 'mt-list-topics'
-        section_listings = soup.find_all('li', class_='mt-list-topics')
+        section_listings = _CHAPTER_LISTINGS(document)
 
         logger.info('Found %d potential section listings', len(section_listings))
 
@@ -149,28 +263,28 @@ def libretext_chapter_parser(url: str) -> dict:
 
         for listing in section_listings:
             # Look for the detailed listing structure
-            dl_element = listing.find('dl', class_='mt-listing-detailed')
+            dl_element = _CHAPTER_DETAILS(listing)
 
             if dl_element:
                 # Extract title and URL from the dt element
-                dt_element = dl_element.find('dt', class_='mt-listing-detailed-title')
-                dd_element = dl_element.find('dd', class_='mt-listing-detailed-overview')
+                dt_element = _CHAPTER_TITLE(dl_element[0])
+                dd_element = _CHAPTER_OVERVIEW(dl_element[0])
 
                 if dt_element:
                     # Find the anchor tag within the dt element
-                    link = dt_element.find('a')
+                    link = _FIRST_LINK(dt_element[0])
 
                     if link:
                         # Extract title from the link text
-                        title = link.get_text(strip=True)
+                        title = link[0].text_content().strip()
 
                         # Extract URL from href attribute
-                        section_url = link.get('href', '')
+                        section_url = link[0].get('href', '')
 
                         # Extract description from the dd element
                         description = ''
                         if dd_element:
-                            description = dd_element.get_text(strip=True)
+                            description = dd_element[0].text_content().strip()
 
                         # Only add meaningful sections (skip empty titles or very short ones)
                         if title and len(title) > 2:
@@ -196,6 +310,34 @@ def libretext_chapter_parser(url: str) -> dict:
         return {'error': f'Unexpected error: {str(e)}'}
 
 
+def libretext_chapters_parser(urls: list, max_workers: int = 8) -> list:
+    """
+    Parse several LibreTexts chapters, fetching them concurrently.
+
+    Args:
+        urls (list): The URLs of the LibreTexts chapter pages.
+        max_workers (int, optional): The most chapters to fetch at once.
+
+    Returns:
+        list: The libretext_chapter_parser() result for each URL, in the same order.
+    """
+
+    if not urls:
+        return []
+
+    logger.info('Parsing %d LibreTexts chapters', len(urls))
+
+    # Fetching is network-bound, so threads overlap the waits. The shared session's
+    # connection pool is big enough for all of them.
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as executor:
+        return list(executor.map(libretext_chapter_parser, urls))
+
+
+# Turns chapter titles into markdown heading anchors, spaces become hyphens and
+# colons and brackets are left out
+_ANCHOR_TRANS = str.maketrans({' ': '-', ':': None, '(': None, ')': None})
+
+
 def save_libretext_book_as_markdown(book_data: dict, filename: str = None, source_url: str = None) -> str:
     """
     Save a complete LibreTexts book dictionary as a markdown formatted file.
@@ -230,71 +372,9 @@ def save_libretext_book_as_markdown(book_data: dict, filename: str = None, sourc
         filename += '.md'
 
     try:
-        # Format the book data as markdown
-        markdown_content = []
-
-        # Book title
-        book_title = book_data.get('title', 'LibreTexts Book')
-        markdown_content.append(f"# {book_title}\n")
-        if source_url:
-            markdown_content.append(f"*Extracted from: {source_url}*\n")
-        markdown_content.append(f"*Generated on: {time.strftime('%Y-%m-%d %H:%M:%S')}*\n\n")
-
-        # Table of contents
-        chapters = book_data.get('chapters', {})
-
-        if chapters:
-            markdown_content.append("## Table of Contents\n")
-
-            for chapter_title in chapters.keys():
-
-                # Create anchor link for the chapter
-                anchor = chapter_title.lower().replace(
-                    ' ',
-                    '-'
-                ).replace(':', '').replace('(', '').replace(')', '')
-
-                markdown_content.append(f"- [{chapter_title}](#{anchor})\n")
-            markdown_content.append("\n---\n\n")
-
-        # Chapter content
-        for chapter_title, chapter_data in chapters.items():
-
-            # Chapter heading
-            markdown_content.append(f"## {chapter_title}\n\n")
-
-            sections = chapter_data.get('sections', {})
-
-            if not sections:
-
-                markdown_content.append("*No sections found for this chapter.*\n\n")
-                continue
-
-            # Section content
-            for section_title, section_data in sections.items():
-
-                # Section heading
-                markdown_content.append(f"### {section_title}\n\n")
-
-                # Section URL
-                section_url = section_data.get('Section url', '')
-
-                if section_url:
-                    markdown_content.append(f"**URL:** [{section_url}]({section_url})\n\n")
-
-                # Section summary
-                section_summary = section_data.get('Section summary', '')
-
-                if section_summary:
-                    markdown_content.append(f"{section_summary}\n\n")
-
-                    markdown_content.append("*No summary available.*\n\n")
-
-                markdown_content.append("---\n\n")
-
-        # Write to file
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.writelines(markdown_content)
+        # Format the book data as markdown, writing it to the file as it is generated
+        with open(filename, 'w', encoding='utf-8', buffering=1 << 20) as f:
+            f.writelines(_iter_markdown(book_data, source_url))
 
         success_msg = f"Successfully saved LibreTexts book as markdown file: {filename}"
         logger.info(success_msg)
@@ -308,16 +388,235 @@ def save_libretext_book_as_markdown(book_data: dict, filename: str = None, sourc
         return error_msg
 
 
+def _iter_markdown(book_data: dict, source_url: str = None):
+    """
+    Format a complete LibreTexts book dictionary as markdown, a piece at a time.
+
+    Args:
+        book_data (dict): The complete book data dictionary from get_libretext_book().
+        source_url (str, optional): The original URL of the book for reference in the markdown.
+
+    Yields:
+        str: The next piece of the markdown document.
+    """
+
+    # Book title
+    book_title = book_data.get('title', 'LibreTexts Book')
+    yield f"# {book_title}\n"
+    if source_url:
+        yield f"*Extracted from: {source_url}*\n"
+    yield f"*Generated on: {time.strftime('%Y-%m-%d %H:%M:%S')}*\n\n"
+
+    # Table of contents
+    chapters = book_data.get('chapters', {})
+
+    if chapters:
+        yield "## Table of Contents\n"
+
+        for chapter_title in chapters.keys():
+
+            # Create anchor link for the chapter
+            anchor = chapter_title.lower().translate(_ANCHOR_TRANS)
+
+            yield f"- [{chapter_title}](#{anchor})\n"
+        yield "\n---\n\n"
+
+    # Chapter content
+    for chapter_title, chapter_data in chapters.items():
+
+        # Chapter heading
+        yield f"## {chapter_title}\n\n"
+
+        sections = chapter_data.get('sections') or {}
+
+        if not sections:
+
+            yield "*No sections found for this chapter.*\n\n"
+            continue
+
+        # Section content
+        for section_title, section_data in sections.items():
+            section_url = section_data.get('Section url')
+            section_summary = section_data.get('Section summary')
+
+            # Section heading
+            yield f"### {section_title}\n\n"
+
+            # Section URL
+            if section_url:
+                yield f"**URL:** [{section_url}]({section_url})\n\n"
+
+            # Section summary
+            if section_summary:
+                yield f"{section_summary}\n\n---\n\n"
+
+            else:
+                yield "*No summary available.*\n\n---\n\n"
+
+
+# Pretty much most elements, but no forms or audio/video.
+ALLOWED_TAGS = frozenset({
+    "a",
+    "abbr",
+    "acronym",
+    "address",
+    "area",
+    "article",
+    "b",
+    "blockquote",
+    "br",
+    "caption",
+    "cite",
+    "code",
+    "col",
+    "colgroup",
+    "dd",
+    "del",
+    "dfn",
+    "div",
+    "dl",
+    "dt",
+    "em",
+    "figcaption",
+    "figure",
+    "footer",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "header",
+    "hgroup",
+    "hr",
+    "i",
+    "img",
+    "ins",
+    "kbd",
+    "li",
+    "map",
+    "nav",
+    "ol",
+    "p",
+    "pre",
+    "q",
+    "s",
+    "samp",
+    "section",
+    "small",
+    "span",
+    "strong",
+    "sub",
+    "sup",
+    "table",
+    "tbody",
+    "td",
+    "tfoot",
+    "th",
+    "thead",
+    "time",
+    "tr",
+    "ul",
+    "var",
+})
+
+# These tags are removed along with their contents.
+CLEAN_CONTENT_TAGS = frozenset({
+    "script",
+    "style",
+})
+
+# These attributes will not be removed from any of the allowed tags.
+ALLOWED_ATTRIBUTES = {
+    "*": frozenset({"class", "id"}),
+    "a": frozenset({"href", "title"}),
+    "abbr": frozenset({"title"}),
+    "acronym": frozenset({"title"}),
+    "img": frozenset({"alt", "src", "srcset"}),
+    # Ugh. Don't know why this page doesn't use .tright like others
+    # http://127.0.0.1:8000/encyclopedia/5040/
+    "table": frozenset({"align"}),
+    "td": frozenset({"align", "colspan", "rowspan", "valign"}),
+    "th": frozenset({"colspan", "rowspan", "scope"}),
+}
+
+# One sanitizer, built once and shared by all pages and threads.
+_CLEANER = nh3.Cleaner(
+    tags=ALLOWED_TAGS,
+    clean_content_tags=CLEAN_CONTENT_TAGS,
+    attributes=ALLOWED_ATTRIBUTES,
+    link_rel=None,
+)
+
+
+# Largest Wikipedia page body WikipediaFetcher will read, in bytes
+MAX_WIKIPEDIA_PAGE_BYTES = 8 * 1024 * 1024
+
+# Headings of the Wikipedia page sections get_wikipedia_page() leaves out, along
+# with everything after them. These end-of-article sections are mostly links.
+WIKIPEDIA_CUTOFF_RE = re.compile(
+    r'<div class="mw-heading mw-heading2">'
+    r'<h2 id="(?:See_also|References|Further_reading|External_links)">'
+)
+
+# CSS selectors. Strip these and their contents.
+STRIP_SELECTORS = [
+    "div.hatnote",
+    "div.navbar.mini",  # Will also match div.mini.navbar
+    # Bottom of https://en.wikipedia.org/wiki/Charles_II_of_England :
+    "div.topicon",
+    "a.mw-headline-anchor",
+    "script",
+    "style",
+]
+
+# Strip any element that has one of these classes.
+STRIP_CLASSES = [
+    # "This article may be expanded with text translated from..."
+    # https://en.wikipedia.org/wiki/Afonso_VI_of_Portugal
+    "ambox-notice",
+    "magnify",
+    # eg audio on https://en.wikipedia.org/wiki/Bagpipes
+    "mediaContainer",
+    "navbox",
+    "noprint",
+]
+
+# Any element has a class matching a key, it will have the classes
+# in the value added.
+ADD_CLASSES = {
+    # Give these tables standard Bootstrap styles.
+    "infobox": ["table", "table-bordered"],
+    "ambox": ["table", "table-bordered"],
+    "wikitable": ["table", "table-bordered"],
+}
+
+# The selectors and classes above combined, so each pass walks the page once
+STRIP_SELECTOR = ", ".join(STRIP_SELECTORS + [f".{clss}" for clss in STRIP_CLASSES])
+ADD_CLASSES_SELECTOR = ", ".join(f".{clss}" for clss in ADD_CLASSES)
+
+# A page containing none of these strings has nothing to strip or add classes to,
+# so it can skip being parsed. Selectors give their first class, or their tag.
+STRIP_HTML_TOKENS = tuple(
+    [sel.split(".")[1] if "." in sel else f"<{sel}" for sel in STRIP_SELECTORS]
+    + STRIP_CLASSES
+    + list(ADD_CLASSES)
+)
+
+
 class WikipediaFetcher:
     """Gets and cleans up Wikipedia pages."""
 
-    def fetch(self, page_name):
+    def fetch(self, page_name, cutoff=None):
         """
         Passed a Wikipedia page's URL fragment, like
         'Edward_Montagu,_1st_Earl_of_Sandwich', this will fetch the page's
         main contents, tidy the HTML, strip out any elements we don't want
         and return the final HTML string.
 
+        If the cutoff regex is given and matches the page's HTML, everything
+        from the first match on is dropped before the HTML is tidied.
+
         Returns a dict with two elements:
             'success' is either True or, if we couldn't fetch the page, False.
             'content' is the HTML if success==True, or else an error message.
@@ -325,7 +624,14 @@ class WikipediaFetcher:
         result = self._get_html(page_name)
 
         if result["success"]:
-            result["content"] = self._tidy_html(result["content"])
+            html = result["content"]
+
+            match = cutoff.search(html) if cutoff is not None else None
+
+            if match:
+                html = html[:match.start()]
+
+            result["content"] = self._tidy_html(html)
 
         return result
 
@@ -344,7 +650,7 @@ class WikipediaFetcher:
         url = f"https://en.wikipedia.org/wiki/{page_name}"
 
         try:
-            response = requests.get(url, params={"action": "render"}, timeout=5)
+            response = SESSION.get(url, params={"action": "render"}, timeout=5, stream=True)
         except requests.exceptions.ConnectionError:
             error_message = "Can't connect to domain."
         except requests.exceptions.Timeout:
@@ -355,16 +661,54 @@ class WikipediaFetcher:
         try:
             response.raise_for_status()
         except requests.exceptions.HTTPError:
-            # 4xx or 5xx errors:
+            # 4xx or 5xx errors, give the streamed connection back to the pool
             error_message = f"HTTP Error: {response.status_code}"
+            response.close()
         except NameError:
             if error_message == "":
                 error_message = "Something unusual went wrong."
 
+        if not error_message:
+            try:
+                content = self._read_capped(response)
+
+            finally:
+                # Releases the connection even if the read stopped early or failed
+                response.close()
+
+            if content is None:
+                error_message = "Page too large."
+
         if error_message:
             return {"success": False, "content": error_message}
         else:
-            return {"success": True, "content": response.text}
+            # Wikipedia always serves UTF-8, so decode it directly rather than
+            # have requests work out the encoding
+            return {"success": True, "content": content.decode("utf-8", errors="replace")}
+
+
+    def _read_capped(self, response):
+        """
+        Reads a streamed response's body, giving up on it once it is bigger
+        than MAX_WIKIPEDIA_PAGE_BYTES.
+
+        Returns the body as bytes, or None if it was too large.
+        """
+        if int(response.headers.get("Content-Length", 0)) > MAX_WIKIPEDIA_PAGE_BYTES:
+            return None
+
+        chunks = []
+        size = 0
+
+        for chunk in response.iter_content(chunk_size=65536):
+            size += len(chunk)
+
+            if size > MAX_WIKIPEDIA_PAGE_BYTES:
+                return None
+
+            chunks.append(chunk)
+
+        return b"".join(chunks)
 
 
     def _tidy_html(self, html):
@@ -386,120 +730,7 @@ class WikipediaFetcher:
         Pass it an HTML string, it'll return the bleached HTML string.
         """
 
-        # Pretty much most elements, but no forms or audio/video.
-        allowed_tags = {
-            "a",
-            "abbr",
-            "acronym",
-            "address",
-            "area",
-            "article",
-            "b",
-            "blockquote",
-            "br",
-            "caption",
-            "cite",
-            "code",
-            "col",
-            "colgroup",
-            "dd",
-            "del",
-            "dfn",
-            "div",
-            "dl",
-            "dt",
-            "em",
-            "figcaption",
-            "figure",
-            "footer",
-            "h1",
-            "h2",
-            "h3",
-            "h4",
-            "h5",
-            "h6",
-            "header",
-            "hgroup",
-            "hr",
-            "i",
-            "img",
-            "ins",
-            "kbd",
-            "li",
-            "map",
-            "nav",
-            "ol",
-            "p",
-            "pre",
-            "q",
-            "s",
-            "samp",
-            "section",
-            "small",
-            "span",
-            "strong",
-            "sub",
-            "sup",
-            "table",
-            "tbody",
-            "td",
-            "tfoot",
-            "th",
-            "thead",
-            "time",
-            "tr",
-            "ul",
-            "var",
-            # We allow script and style here, so we can close/un-mis-nest
-            # its tags, but then it's removed completely in _strip_html():
-            "script",
-            "style",
-        }
-
-        # These attributes will not be removed from any of the allowed tags.
-        allowed_attributes = {
-            "*": ["class", "id"],
-            "a": ["href", "title"],
-            "abbr": ["title"],
-            "acronym": ["title"],
-            "img": ["alt", "src", "srcset"],
-            # Ugh. Don't know why this page doesn't use .tright like others
-            # http://127.0.0.1:8000/encyclopedia/5040/
-            "table": ["align"],
-            "td": ["colspan", "rowspan", "style"],
-            "th": ["colspan", "rowspan", "scope"],
-        }
-
-        # These CSS properties are allowed within style attributes
-        # Added for the family tree on /encyclopedia/5825/
-        # Hopefully doesn't make anything else too hideous.
-        allowed_css_properties = [
-            "background",
-            "border",
-            "border-bottom",
-            "border-collapse",
-            "border-left",
-            "border-radius",
-            "border-right",
-            "border-spacing",
-            "border-top",
-            "height",
-            "padding",
-            "text-align",
-            "width",
-        ]
-
-        css_sanitizer = CSSSanitizer(allowed_css_properties=allowed_css_properties)
-
-        a = bleach.clean(
-            html,
-            tags=allowed_tags,
-            attributes=allowed_attributes,
-            css_sanitizer=css_sanitizer,
-            strip=True,
-        )
-
-        return a
+        return _CLEANER.clean(html)
 
 
     def _strip_html(self, html):
@@ -511,58 +742,40 @@ class WikipediaFetcher:
         Pass it an HTML string, it returns the stripped HTML string.
         """
 
-        # CSS selectors. Strip these and their contents.
-        selectors = [
-            "div.hatnote",
-            "div.navbar.mini",  # Will also match div.mini.navbar
-            # Bottom of https://en.wikipedia.org/wiki/Charles_II_of_England :
-            "div.topicon",
-            "a.mw-headline-anchor",
-            "script",
-            "style",
-        ]
+        # Scanning the string is much quicker than parsing it
+        if not any(token in html for token in STRIP_HTML_TOKENS):
+            return html
 
-        # Strip any element that has one of these classes.
-        classes = [
-            # "This article may be expanded with text translated from..."
-            # https://en.wikipedia.org/wiki/Afonso_VI_of_Portugal
-            "ambox-notice",
-            "magnify",
-            # eg audio on https://en.wikipedia.org/wiki/Bagpipes
-            "mediaContainer",
-            "navbox",
-            "noprint",
-        ]
+        tree = LexborHTMLParser(html)
+
+        # Removed nodes are only detached, so nodes nested inside one that
+        # was already removed are still safe to remove
+        for node in tree.css(STRIP_SELECTOR):
+            node.remove()
 
-        # Any element has a class matching a key, it will have the classes
-        # in the value added.
-        add_classes = {
-            # Give these tables standard Bootstrap styles.
-            "infobox": ["table", "table-bordered"],
-            "ambox": ["table", "table-bordered"],
-            "wikitable": ["table", "table-bordered"],
-        }
+        # A node matching more than one of the classes is returned once
+        # per match, so only update each node once
+        updated = set()
 
-        soup = BeautifulSoup(html, "lxml")
+        for node in tree.css(ADD_CLASSES_SELECTOR):
+            if node.mem_id in updated:
+                continue
 
-        for selector in selectors:
-            _ = [tag.decompose() for tag in soup.select(selector)]
+            updated.add(node.mem_id)
+            node_classes = node.attributes.get("class", "").split()
+            classes = list(node_classes)
 
-        for clss in classes:
-            _ = [tag.decompose() for tag in soup.find_all(attrs={"class": clss})]
+            for clss, new_classes in ADD_CLASSES.items():
+                if clss in node_classes:
+                    classes += new_classes
 
-        for clss, new_classes in add_classes.items():
-            for tag in soup.find_all(attrs={"class": clss}):
-                tag["class"] = tag.get("class", []) + new_classes
+            node.attrs["class"] = " ".join(classes)
 
-        # Depending on the HTML parser BeautifulSoup used, soup may have
-        # surrounding <html><body></body></html> or just <body></body> tags.
-        if soup.body:
-            soup = soup.body
-        elif soup.html:
-            soup = soup.html.body
+        # The parser puts the content into a full <html><body></body></html>
+        # document, put the body's content back into a string.
+        if tree.body is None:
+            return ""
 
-        # Put the content back into a string.
-        html = "".join(str(tag) for tag in soup.contents)
+        html = tree.body.inner_html
 
         return html
@@ -1,11 +1,20 @@
 '''Tools for GAIA question answering agent.'''
 
+import os
+import copy
 import time
+import atexit
+import functools
+import queue
 import logging
-import requests
+import threading
+from itertools import islice
+from types import MappingProxyType
+from urllib.parse import urlencode, urljoin
+from concurrent.futures import ThreadPoolExecutor
 from smolagents import tool
 from googlesearch import search
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
@@ -14,17 +23,189 @@ from selenium.webdriver.chrome.options import Options
 from selenium.common.exceptions import TimeoutException, WebDriverException
 from functions.tool_helper_functions import (
     libretext_book_parser,
-    libretext_chapter_parser,
+    libretext_chapters_parser,
     save_libretext_book_as_markdown,
-    WikipediaFetcher
+    serper_search,
+    WikipediaFetcher,
+    WIKIPEDIA_CUTOFF_RE,
+    MAX_LIBRETEXTS_PAGE_BYTES,
+    SESSION
 )
+from configuration import AGENT_CONCURRENCY
 
 # Get logger for this module
 logger = logging.getLogger(__name__)
 
+# The fetcher keeps no state between pages, so one is shared by all calls. It gets
+# pages through the shared keep-alive session.
+WIKIPEDIA_FETCHER = WikipediaFetcher()
+
+# Wikimedia search API endpoint and request headers for wikipedia_search,
+# Wikimedia asks API clients to identify themselves in the user agent
+REPO_URL = 'https://github.com/gperdrizet/unit-four-final-project'
+WIKIPEDIA_SEARCH_URL = 'https://api.wikimedia.org/core/v1/wikipedia/en/search/page'
+WIKIPEDIA_SEARCH_HEADERS = MappingProxyType({
+    'User-Agent': f'HuggingFace Agents course final project ({REPO_URL})'
+})
+
+# LibreTexts chemistry library, searched by libretext_book_search
+LIBRETEXTS_URL = 'https://chem.libretexts.org'
+
+# Configure Chrome options for headless mode
+CHROME_OPTIONS = Options()
+CHROME_OPTIONS.add_argument("--headless")
+CHROME_OPTIONS.add_argument("--no-sandbox")
+CHROME_OPTIONS.add_argument("--disable-dev-shm-usage")
+CHROME_OPTIONS.add_argument("--disable-gpu")
+CHROME_OPTIONS.add_argument("--window-size=1920,1080")
+CHROME_OPTIONS.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) " +
+    "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
+
+# Starting Chrome is slow, so libretext_book_search keeps its browsers for later
+# searches. A WebDriver can only run one search at a time, so concurrent searches
+# each take an idle browser from the pool, starting a new one if there are none,
+# up to one per concurrent agent.
+MAX_DRIVERS = AGENT_CONCURRENCY
+_IDLE_DRIVERS = queue.LifoQueue()
+_DRIVER_SLOTS = threading.BoundedSemaphore(MAX_DRIVERS)
+_DRIVERS = set()
+_DRIVERS_LOCK = threading.Lock()
+
+
+def _get_driver() -> webdriver.Chrome:
+    """Takes a Chrome driver from the pool, waiting while they are all in use."""
+
+    _DRIVER_SLOTS.acquire()
+
+    try:
+        return _IDLE_DRIVERS.get_nowait()
+
+    except queue.Empty:
+        pass
+
+    try:
+        driver = webdriver.Chrome(options=CHROME_OPTIONS)
+
+    except BaseException:
+        _DRIVER_SLOTS.release()
+        raise
+
+    with _DRIVERS_LOCK:
+        _DRIVERS.add(driver)
+
+    return driver
+
+
+def _release_driver(driver: webdriver.Chrome, broken: bool = False) -> None:
+    """Returns a Chrome driver to the pool, or quits it if it is broken."""
+
+    if broken:
+        _quit_driver(driver)
+
+    else:
+        _IDLE_DRIVERS.put(driver)
+
+    _DRIVER_SLOTS.release()
+
+
+def _quit_driver(driver: webdriver.Chrome) -> None:
+    """Quits a Chrome driver and forgets it."""
+
+    with _DRIVERS_LOCK:
+        _DRIVERS.discard(driver)
+
+    try:
+        driver.quit()
+
+    except Exception as e: # pylint:disable=broad-exception-caught
+        logger.warning('Error closing driver: %s', str(e))
+
+
+def _shutdown_drivers() -> None:
+    """Quits all the Chrome drivers."""
+
+    with _DRIVERS_LOCK:
+        drivers = list(_DRIVERS)
+
+    for driver in drivers:
+        _quit_driver(driver)
+
+
+# Close the browsers when the app exits
+atexit.register(_shutdown_drivers)
+
+
+def _result_description(result, title: str) -> str:
+    """
+    Finds the description in a LibreTexts search result: the text of the first
+    p, span or div inside it, in document order, that is over 20 characters
+    long and isn't just the title.
+
+    Args:
+        result (Node): The search result's selectolax node.
+        title (str): The result's title, or None.
+
+    Returns:
+        str: The description, or None if there isn't one.
+    """
+
+    node = result.child
+
+    while node is not None:
+        descend = True
+
+        if node.tag in ('p', 'span', 'div'):
+            text = node.text(strip=True)
+
+            if len(text) > 20 and text != title:
+                return text
+
+            # The text of anything inside is part of this text, so it can't be long enough either
+            if len(text) <= 20:
+                descend = False
+
+        if descend and node.child is not None:
+            node = node.child
+            continue
+
+        # Move on to the next node, climbing back up out of finished subtrees
+        while node is not None and node.next is None:
+            node = node.parent
+
+            if node is None or node.mem_id == result.mem_id:
+                return None
+
+        node = node.next if node is not None else None
+
+    return None
+
+
+# Agents often repeat searches and revisit pages, so the tool bodies below keep
+# their most recent results. Failed lookups are not cached, they are handed back
+# to the tool through _Uncached instead.
+TOOL_CACHE_SIZE = 128
+
+# Web search results change, so cached ones are only reused for a few minutes,
+# long enough to absorb an agent repeating itself. In seconds.
+SEARCH_CACHE_TTL = 300
+
+
+class _Uncached(Exception):
+    """Carries a result, like an error message, out of a cached tool body without caching it."""
+
+    def __init__(self, result):
+        super().__init__(result)
+        self.result = result
+
+
+def _cache_key(query: str) -> str:
+    """Normalizes the whitespace in a query, so trivially different queries share cache entries."""
+
+    return ' '.join(query.split())
+
 
 @tool
-def google_search(query: str) -> dict:
+def google_search(query: str) -> list[dict]:
     """
     Perform a Google search and return the top 10 results.
     
@@ -32,29 +213,52 @@ def google_search(query: str) -> dict:
         query (str): The search query.
         
     Returns:
-        dict: A dictionary containing the search results in the following format.
-        {0: {'title': str, 'url': str, 'description': str}, ...}
+        list: The search results in the following format.
+        [{'title': str, 'url': str, 'description': str}, ...]
+        On failure, a single item list holding the error.
+        [{'error': str}]
     """
 
-    # Run the query
-    results = list(search(query, num_results=10, advanced=True))
+    try:
+        # Results are cached per time window, so they are refetched once it has passed
+        return copy.deepcopy(
+            _google_search(_cache_key(query), int(time.monotonic() // SEARCH_CACHE_TTL))
+        )
+
+    except _Uncached as e:
+        return e.result
 
-    # Parse and format the results
-    parsed_results = {}
 
-    for i, result in enumerate(results):
+@functools.lru_cache(maxsize=TOOL_CACHE_SIZE)
+def _google_search(query: str, time_window: int) -> list: # pylint: disable=unused-argument
+    """Runs google_search(), results are cached by query and time window."""
 
-        parsed_results[i] = {
+    # Use the Serper JSON API if there is a key for it, it is much faster than
+    # scraping the Google results page
+    if os.environ.get('SERPER_API_KEY'):
+        results = serper_search(query, num_results=10)
+
+        if isinstance(results, dict):
+            raise _Uncached([results])
+
+        return results
+
+    # Run the query, taking the results as the generator yields them
+    results = islice(search(query, num_results=10, advanced=True), 10)
+
+    # Parse and format the results
+    return [
+        {
             'title': result.title,
             'url': result.url,
             'description': result.description
         }
-
-    return parsed_results
+        for result in results
+    ]
 
 
 @tool
-def wikipedia_search(query: str) -> dict:
+def wikipedia_search(query: str) -> list[dict]:
     """
     Perform a search for wikipedia pages and return the top 5 results.
     
@@ -62,39 +266,71 @@ def wikipedia_search(query: str) -> dict:
         query (str): The search query.
         
     Returns:
-        dict: A dictionary containing the search results in the following format.
-        {0: {'title': str, 'description': str}, ...}
+        list: The search results in the following format.
+        [{'title': str, 'description': str}, ...]
+        On failure, a single item list holding the error.
+        [{'error': str}]
     """
 
-    repo_url = 'https://github.com/gperdrizet/unit-four-final-project'
+    try:
+        return copy.deepcopy(_wikipedia_search(_cache_key(query)))
 
-    language_code = 'en'
-    number_of_results = 5
-    headers = {
-        'User-Agent': f'HuggingFace Agents course final project ({repo_url})'
-    }
+    except _Uncached as e:
+        return e.result
 
-    base_url = 'https://api.wikimedia.org/core/v1/wikipedia/'
-    endpoint = '/search/page'
-    url = base_url + language_code + endpoint
+
+@functools.lru_cache(maxsize=TOOL_CACHE_SIZE)
+def _wikipedia_search(query: str) -> list:
+    """Runs wikipedia_search(), results are cached by query."""
+
+    number_of_results = 5
     parameters = {'q': query, 'limit': number_of_results}
-    response = requests.get(url, headers=headers, params=parameters, timeout=15)
+    response = SESSION.get(
+        WIKIPEDIA_SEARCH_URL,
+        headers=WIKIPEDIA_SEARCH_HEADERS,
+        params=parameters,
+        timeout=15
+    )
 
     if response.status_code == 200:
         results = response.json().get('pages', [])
-        parsed_results = {}
 
     else:
-        return f"Error: Unable to retrieve page. Status code {response.status_code}"
+        raise _Uncached([
+            {'error': f'Unable to retrieve search results. Status code {response.status_code}'}
+        ])
 
-    for i, result in enumerate(results):
-
-        parsed_results[i] = {
+    return [
+        {
             'title': result.get('title', None),
             'description': result.get('description', None)
         }
+        for result in results
+    ]
+
 
-    return parsed_results
+@tool
+def wikipedia_searches(queries: list[str]) -> dict:
+    """
+    Perform several searches for wikipedia pages at once and return the top 5
+    results for each. Faster than calling wikipedia_search once per query.
+
+    Args:
+        queries (list): The search queries.
+
+    Returns:
+        dict: A dictionary of wikipedia_search results keyed by query, in the following format.
+        {query: [{'title': str, 'description': str}, ...], ...}
+    """
+
+    if not queries:
+        return {}
+
+    # Searches are network-bound, so threads overlap the waits
+    with ThreadPoolExecutor(max_workers=min(8, len(queries))) as executor:
+        results = executor.map(wikipedia_search, queries)
+
+        return dict(zip(queries, results))
 
 
 @tool
@@ -110,24 +346,29 @@ def get_wikipedia_page(query: str) -> str:
         str: The HTML content of the Wikipedia page.
     """
 
-    fetcher = WikipediaFetcher()
-    html_result = fetcher.fetch(query.replace(' ', '_'))
+    try:
+        return _get_wikipedia_page(_cache_key(query))
+
+    except _Uncached as e:
+        return e.result
+
 
-    content = html_result['content']
+@functools.lru_cache(maxsize=TOOL_CACHE_SIZE)
+def _get_wikipedia_page(query: str) -> str:
+    """Runs get_wikipedia_page(), pages are cached by query."""
 
-    content = content.split(
-        '<div class="mw-heading mw-heading2"><h2 id="Further_reading">Further reading</h2></div>'
-    )[0]
+    # Cut the page at the end-of-article sections before tidying, so only the part
+    # kept is processed
+    html_result = WIKIPEDIA_FETCHER.fetch(query.replace(' ', '_'), cutoff=WIKIPEDIA_CUTOFF_RE)
 
-    content = content.split(
-        '<div class="mw-heading mw-heading2"><h2 id="References">References</h2></div>'
-    )[0]
+    if not html_result['success']:
+        raise _Uncached(html_result['content'])
 
-    return content
+    return html_result['content']
 
 
 @tool
-def libretext_book_search(query: str) -> dict:
+def libretext_book_search(query: str) -> list[dict]:
     """
     Search for LibreTexts books using Selenium to handle JavaScript-rendered content.
     
@@ -135,27 +376,21 @@ def libretext_book_search(query: str) -> dict:
         query (str): The search query.
         
     Returns:
-        dict: A dictionary containing the search results in the following format.
-        {0: {'title': str, 'url': str, 'description': str}, ...}
+        list: The search results in the following format.
+        [{'title': str, 'url': str, 'description': str}, ...]
+        On failure, a single item list holding the error.
+        [{'error': str}]
     """
 
-    # Configure Chrome options for headless mode
-    chrome_options = Options()
-    chrome_options.add_argument("--headless")
-    chrome_options.add_argument("--no-sandbox")
-    chrome_options.add_argument("--disable-dev-shm-usage")
-    chrome_options.add_argument("--disable-gpu")
-    chrome_options.add_argument("--window-size=1920,1080")
-    chrome_options.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) " +
-        "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
-
     driver = None
+    broken = False
+
     try:
-        # Initialize the Chrome driver
-        driver = webdriver.Chrome(options=chrome_options)
+        # Get a Chrome driver from the pool
+        driver = _get_driver()
 
         # Construct search URL
-        search_url = 'https://chem.libretexts.org/Special:Search'
+        search_url = f'{LIBRETEXTS_URL}/Special:Search'
         params = {
             'qid': '',
             'fpid': '230',
@@ -164,8 +399,7 @@ def libretext_book_search(query: str) -> dict:
         }
 
         # Build URL with parameters
-        param_string = '&'.join([f"{k}={v}" for k, v in params.items()])
-        full_url = f"{search_url}?{param_string}"
+        full_url = f"{search_url}?{urlencode(params)}"
 
         logger.info('Selenium search URL: %s', full_url)
 
@@ -183,33 +417,49 @@ def libretext_book_search(query: str) -> dict:
                 EC.presence_of_element_located((By.ID, "mt-search-spblls"))
             )
 
-            # Give additional time for JavaScript to populate results
-            time.sleep(3)
+            # Wait for JavaScript to populate the results, if none show up in
+            # time, carry on and let the fallback selectors below have a look
+            try:
+                WebDriverWait(driver, 5).until(
+                    lambda d: d.find_elements(
+                        By.CSS_SELECTOR,
+                        "#mt-search-spblls div.mt-search-information"
+                    )
+                )
+
+            except TimeoutException:
+                logger.info('No mt-search-information results after waiting, trying fallbacks')
 
             # Get the page source after JavaScript execution
             page_source = driver.page_source
-            soup = BeautifulSoup(page_source, 'html.parser')
+
+            if len(page_source) > MAX_LIBRETEXTS_PAGE_BYTES:
+                logger.error('Search page too large: %d characters', len(page_source))
+                return [{'error': 'Search page too large.'}]
+
+            tree = LexborHTMLParser(page_source)
 
             # Look for search results using multiple possible selectors
-            search_info_divs = soup.find_all('div', class_='mt-search-information')
+            search_info_divs = tree.css('div.mt-search-information')
 
             # If no results with that class, try other common search result patterns
             if not search_info_divs:
                 # Try alternative selectors that might be used for search results
-                search_info_divs = soup.find_all('div', class_='search-result')
+                search_info_divs = tree.css('div.search-result')
                 if not search_info_divs:
-                    search_info_divs = soup.find_all('div', class_='result')
+                    search_info_divs = tree.css('div.result')
                 if not search_info_divs:
                     # Look for any divs within the search results container
-                    results_container = soup.find('div', id='mt-search-spblls')
+                    results_container = tree.css_first('div#mt-search-spblls')
                     if results_container:
-                        search_info_divs = results_container.find_all('div', recursive=False)
+                        search_info_divs = [
+                            child for child in results_container.iter() if child.tag == 'div'
+                        ]
 
             logger.info('Found %d potential search result divs', len(search_info_divs))
 
             # Parse the search results
-            parsed_results = {}
-            result_count = 0
+            parsed_results = []
 
             for div in search_info_divs:
                 # Try to extract title and URL from various possible structures
@@ -218,63 +468,64 @@ def libretext_book_search(query: str) -> dict:
                 summary = None
 
                 # Look for title in anchor tags
-                title_link = div.find('a')
+                title_link = div.css_first('a')
                 if title_link:
-                    title = title_link.get_text(strip=True)
-                    url = title_link.get('href', '')
+                    title = title_link.text(strip=True)
+                    url = title_link.attributes.get('href') or ''
 
                     # Make URL absolute if it's relative
-                    if url and url.startswith('/'):
-                        url = 'https://chem.libretexts.org' + url
+                    if url:
+                        url = urljoin(LIBRETEXTS_URL, url)
 
                 # Look for description/summary text
-                # Try multiple approaches to find descriptive text
-                text_elements = div.find_all(['p', 'span', 'div'])
-                for element in text_elements:
-                    text = element.get_text(strip=True)
-                    if text and len(text) > 20 and not title or text != title:
-                        summary = text
-                        break
+                summary = _result_description(div, title)
 
                 # Only add to results if we have at least a title
                 if title and len(title) > 3:  # Ensure title is meaningful
-                    parsed_results[result_count] = {
+                    parsed_results.append({
                         'title': title,
                         'url': url or '',
                         'description': summary or ''
-                    }
+                    })
 
                     logger.debug(
                         'Extracted result %d: title="%s", url="%s"',
-                        result_count,
+                        len(parsed_results) - 1,
                         title,
                         url
                     )
 
-                    result_count += 1
-
             logger.info('Successfully extracted %d search results', len(parsed_results))
             return parsed_results
 
         except TimeoutException:
             logger.error('Timeout waiting for search results to load')
-            return {'error': 'Timeout waiting for search results to load'}
+            return [{'error': 'Timeout waiting for search results to load'}]
 
     except WebDriverException as e:
         logger.error('WebDriver error: %s', str(e))
-        return {'error': f'WebDriver error: {str(e)}'}
+
+        # The browser may have crashed or lost its session, replace it
+        broken = True
+
+        return [{'error': f'WebDriver error: {str(e)}'}]
 
     except Exception as e: # pylint:disable=broad-exception-caught
         logger.error('Unexpected error in Selenium search: %s', str(e))
-        return {'error': f'Unexpected error: {str(e)}'}
+        return [{'error': f'Unexpected error: {str(e)}'}]
 
     finally:
-        # Always clean up the driver
+        # Always leave the browser clean for the next search
         if driver:
-            try:
-                driver.quit()
-            except Exception as e: # pylint:disable=broad-exception-caught
-                logger.warning('Error closing driver: %s', str(e))
+            if not broken:
+                try:
+                    driver.delete_all_cookies()
+                    driver.get('about:blank')
+                except Exception as e: # pylint:disable=broad-exception-caught
+                    logger.warning('Error resetting driver: %s', str(e))
+                    broken = True
+
+            _release_driver(driver, broken)
 
 
 @tool
@@ -326,16 +577,17 @@ def get_libretext_book(url: str) -> dict:
 
     logger.info('Found %d chapters to process', len(book_data))
 
+    # Get the sections for all chapters at once
+    chapters = list(book_data.values())
+    chapters_sections = libretext_chapters_parser([chapter['url'] for chapter in chapters])
+
     # Process each chapter
-    for chapter_info in book_data.values():
+    for chapter_info, sections_data in zip(chapters, chapters_sections):
         chapter_title = chapter_info['title']
         chapter_url = chapter_info['url']
 
         logger.info('Processing chapter: %s', chapter_title)
 
-        # Get sections for this chapter
-        sections_data = libretext_chapter_parser(chapter_url)
-
         # Initialize chapter structure
         complete_book['chapters'][chapter_title] = {
             'sections': {}
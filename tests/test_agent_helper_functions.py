@@ -0,0 +1,259 @@
+'''Unittests for agent helper functions.'''
+
+import re
+import unittest
+from unittest import mock
+from concurrent.futures import Future
+from smolagents import ActionStep, PlanningStep, TaskStep
+from smolagents.models import ChatMessage
+from smolagents.monitoring import Timing, TokenUsage
+from functions import agent_helper_functions
+from functions.agent_helper_functions import step_memory_cap, _TokenBucket
+from configuration import TOKEN_LIMITER
+
+
+class _Agent:
+    '''Stand-in for a CodeAgent, step_memory_cap only uses its memory.'''
+
+    def __init__(self, steps: list):
+        self.memory = mock.Mock(steps=steps)
+
+
+def _message(text: str) -> dict:
+    '''Returns a text message in agent memory format.'''
+
+    return {'role': 'user', 'content': [{'type': 'text', 'text': text}]}
+
+
+def _action_step(
+        step_number: int,
+        model_input_messages: list = None,
+        tokens: int = TOKEN_LIMITER + 1
+) -> ActionStep:
+    '''Returns an action step, by default one that used more tokens than the limit.'''
+
+    if model_input_messages is None:
+        model_input_messages = [_message('System prompt'), _message(f'Context {step_number}')]
+
+    return ActionStep(
+        step_number=step_number,
+        timing=Timing(start_time=0),
+        model_input_messages=model_input_messages,
+        model_output=f'Output {step_number}',
+        observations=f'Observation {step_number}',
+        token_usage=TokenUsage(input_tokens=tokens, output_tokens=0)
+    )
+
+
+def _planning_step(tokens: int = TOKEN_LIMITER + 1) -> PlanningStep:
+    '''Returns a planning step, by default one that used more tokens than the limit.'''
+
+    return PlanningStep(
+        model_input_messages=[_message('Planning prompt')],
+        model_output_message=ChatMessage(role='assistant', content='Plan'),
+        plan='Plan',
+        timing=Timing(start_time=0),
+        token_usage=TokenUsage(input_tokens=tokens, output_tokens=0)
+    )
+
+
+class _ManualExecutor:
+    '''Stand-in for the summary pool, summaries only run when the test finishes them.'''
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, function, *args):
+        '''Queues the call and returns a future for it.'''
+
+        future = Future()
+        self.submitted.append((future, function, args))
+
+        return future
+
+    def finish(self):
+        '''Runs the queued calls, completing their futures.'''
+
+        for future, function, args in self.submitted:
+            future.set_result(function(*args))
+
+        self.submitted = []
+
+
+class TestStepMemoryCap(unittest.TestCase):
+    '''Tests for the step_memory_cap step callback.'''
+
+    def setUp(self):
+
+        # Memory as seen by the step 6 callback with planning_interval=5, the
+        # plan for step 6 is in memory but the step 6 action step is not yet
+        self.agent = _Agent(
+            [TaskStep(task='Task'), _planning_step()] +
+            [_action_step(step_number) for step_number in range(1, 6)] +
+            [_planning_step()]
+        )
+
+        patcher = mock.patch.object(
+            agent_helper_functions,
+            'summarize_old_messages',
+            return_value='Summary'
+        )
+
+        self.summarize = patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def test_planning_step_last(self):
+        '''Memory ending in a planning step should be trimmed without summarizing.'''
+
+        step_memory_cap(_action_step(6), self.agent)
+
+        self.assertIsInstance(self.agent.memory.steps[-1], PlanningStep)
+        self.assertEqual(len(self.agent.memory.steps), 3)
+        self.assertNotIn(self.agent, agent_helper_functions._PENDING_SUMMARIES) # pylint: disable=protected-access
+
+
+    def test_summary_after_planning_step(self):
+        '''The summary should start from the next action step.'''
+
+        step_memory_cap(_action_step(6), self.agent)
+        self.agent.memory.steps.append(_action_step(6))
+        step_memory_cap(_action_step(7), self.agent)
+
+        summary_future, _ = agent_helper_functions._PENDING_SUMMARIES[self.agent] # pylint: disable=protected-access
+        summary_future.result()
+
+        self.summarize.assert_called_once()
+        self.assertEqual(agent_helper_functions._SUMMARIZED_UP_TO[self.agent], 6) # pylint: disable=protected-access
+
+
+class TestRollingSummary(unittest.TestCase):
+    '''Tests that every step trimmed from memory makes it into a summary.'''
+
+    def setUp(self):
+
+        self.summarized_steps = set()
+        self.executor = _ManualExecutor()
+
+        for patcher in (
+            mock.patch.object(
+                agent_helper_functions,
+                'summarize_old_messages',
+                side_effect=self._summarize
+            ),
+            mock.patch.object(agent_helper_functions, '_SUMMARY_POOL', self.executor)
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+    def _summarize(self, messages: list, previous_summary: str = None) -> str: # pylint: disable=unused-argument
+        '''Records the steps whose output was sent for summarization.'''
+
+        for message in messages:
+            for part in message['content']:
+                self.summarized_steps.update(
+                    int(step_number) for step_number in re.findall(r'Output (\d+)', part['text'])
+                )
+
+        return 'Summary'
+
+
+    def _run(self, steps: int, delay: int) -> _Agent:
+        '''Runs an agent with planning_interval=5 through the memory callback, going
+        over the token limit from step 6. Background summaries only finish every
+        delay steps, so they land up to delay steps late. Returns the agent.'''
+
+        agent = _Agent([TaskStep(task='Task')])
+
+        for step_number in range(1, steps + 1):
+            tokens = TOKEN_LIMITER + 1 if step_number >= 6 else 0
+
+            if step_number % delay == 0:
+                self.executor.finish()
+
+            if step_number == 1 or (step_number - 1) % 5 == 0:
+                agent.memory.steps.append(_planning_step(tokens))
+
+            # The step sees memory as it is when the step starts, as in CodeAgent
+            context = [_message('System prompt')] + [
+                message for step in agent.memory.steps for message in step.to_messages()
+            ]
+
+            action_step = _action_step(step_number, context, tokens)
+            step_memory_cap(action_step, agent)
+            agent.memory.steps.append(action_step)
+
+        return agent
+
+
+    def test_no_steps_lost(self):
+        '''Every step up to the last summarized one should have been summarized.'''
+
+        for delay in (1, 2, 3):
+            with self.subTest(delay=delay):
+                self.summarized_steps.clear()
+                agent = self._run(steps=20, delay=delay)
+                self.executor.finish()
+
+                summarized_up_to = agent_helper_functions._SUMMARIZED_UP_TO[agent] # pylint: disable=protected-access
+
+                self.assertGreater(summarized_up_to, 10)
+                self.assertEqual(
+                    set(range(1, summarized_up_to + 1)) - self.summarized_steps,
+                    set()
+                )
+
+
+
+class TestTokenBucket(unittest.TestCase):
+    '''Tests for the token bucket rate limiter.'''
+
+    def setUp(self):
+
+        # Control the clock and record waits instead of sleeping
+        patcher = mock.patch.object(agent_helper_functions, 'time')
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.time.monotonic.return_value = 0.0
+        self.bucket = _TokenBucket(rate=10, capacity=100)
+
+
+    def test_no_wait_under_capacity(self):
+        '''Taking tokens the bucket has should not wait.'''
+
+        self.assertEqual(self.bucket.acquire(60), 0.0)
+        self.time.sleep.assert_not_called()
+
+
+    def test_wait_in_debt(self):
+        '''Going into debt should wait until the debt has been refilled.'''
+
+        self.bucket.acquire(60)
+
+        self.assertAlmostEqual(self.bucket.acquire(60), 2.0)
+        self.time.sleep.assert_called_once()
+        self.assertAlmostEqual(self.time.sleep.call_args.args[0], 2.0)
+
+
+    def test_refill(self):
+        '''Tokens should refill with time, paying off debt.'''
+
+        self.bucket.acquire(150)
+        self.time.monotonic.return_value = 10.0
+
+        self.assertEqual(self.bucket.acquire(50), 0.0)
+
+
+    def test_capped_at_capacity(self):
+        '''Idle time should not fill the bucket past its capacity.'''
+
+        self.time.monotonic.return_value = 1000.0
+
+        self.assertEqual(self.bucket.acquire(100), 0.0)
+        self.assertAlmostEqual(self.bucket.acquire(10), 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,33 +1,88 @@
 '''Unittests for agent tools.'''
 
 import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from selectolax.lexbor import LexborHTMLParser
 from functions.tools import (
     google_search,
     wikipedia_search,
     get_wikipedia_page,
     libretext_book_search,
-    get_libretext_book
+    get_libretext_book,
+    _result_description
 )
 from functions.tool_helper_functions import (
     libretext_book_parser,
-    libretext_chapter_parser
+    libretext_chapter_parser,
+    SESSION
 )
 
+BOOK_URL = 'https://chem.libretexts.org/Bookshelves/Introductory_Chemistry/Introductory_Chemistry_(CK-12)'
+CHAPTER_URL = BOOK_URL + '/01%3A_Introduction_to_Chemistry'
+
+# Saved LibreTexts pages for the get_libretext_book test, by the URL they stand in for
+FIXTURES_DIR = Path(__file__).parent / 'fixtures' / 'libretexts'
+
+LIBRETEXTS_FIXTURES = {
+    BOOK_URL: 'book.html',
+    CHAPTER_URL: 'chapter_01.html',
+    BOOK_URL + '/02%3A_Matter_and_Change': 'chapter_02.html',
+}
+
+# The data each fast test class checks, as the tool call that fetches it. The slow
+# classes fetch their own in setUpClass, so deselecting them skips their fetches too
+FETCHES = {
+    'google_search': (google_search, 'Python programming language'),
+    'wikipedia_search': (wikipedia_search, 'Python programming language'),
+    'get_wikipedia_page': (get_wikipedia_page, 'Mercedes Sosa'),
+    'libretext_chapter_parser': (libretext_chapter_parser, CHAPTER_URL),
+}
+
+# Futures for the fetches, started together by setUpModule()
+_RESULTS = {}
+
+
+def setUpModule():
+    '''Starts all the test classes' fetches at once. They are independent and
+    wait on the network, so the run takes about as long as the slowest one
+    instead of all of them in turn. Each class waits for its own result only.'''
+
+    executor = ThreadPoolExecutor(max_workers=len(FETCHES))
+
+    for name, (function, argument) in FETCHES.items():
+        _RESULTS[name] = executor.submit(function, argument)
+
+    executor.shutdown(wait=False)
+
+
+def _fixture_get(url, **_):
+    '''Stands in for SESSION.get, answering with the saved page for the URL.'''
+
+    return SimpleNamespace(
+        status_code=200,
+        content=(FIXTURES_DIR / LIBRETEXTS_FIXTURES[url]).read_bytes(),
+        raise_for_status=lambda: None
+    )
+
 
 class TestGoogleSearch(unittest.TestCase):
     '''Tests for the google search tool.'''
 
 
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
 
-        google_search_query = 'Python programming language'
-        self.search_results = google_search(google_search_query)
+        cls.search_results = _RESULTS['google_search'].result()
 
 
     def test_result_type(self):
-        '''Search results should be a dictionary.'''
+        '''Search results should be a list.'''
 
-        self.assertIsInstance(self.search_results, dict)
+        self.assertIsInstance(self.search_results, list)
 
 
     def test_result_length(self):
@@ -39,7 +94,7 @@ class TestGoogleSearch(unittest.TestCase):
     def test_result_content(self):
         '''Each search result should contain three elements: title, link, and snippet.'''
 
-        for result in self.search_results.values():
+        for result in self.search_results:
             self.assertIsInstance(result, dict)
             self.assertIn('title', result)
             self.assertIn('url', result)
@@ -53,16 +108,16 @@ class TestWikipediaSearch(unittest.TestCase):
     '''Tests for the wikipedia search tool.'''
 
 
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
 
-        wikipedia_search_query = 'Python programming language'
-        self.search_results = wikipedia_search(wikipedia_search_query)
+        cls.search_results = _RESULTS['wikipedia_search'].result()
 
 
     def test_result_type(self):
-        '''Search results should be a dictionary.'''
+        '''Search results should be a list.'''
 
-        self.assertIsInstance(self.search_results, dict)
+        self.assertIsInstance(self.search_results, list)
 
 
     def test_result_length(self):
@@ -74,7 +129,7 @@ class TestWikipediaSearch(unittest.TestCase):
     def test_result_content(self):
         '''Each search result should contain three elements: title, link, and snippet.'''
 
-        for _, result in self.search_results.items():
+        for result in self.search_results:
             self.assertIsInstance(result, dict)
             self.assertIn('title', result)
             self.assertIn('description', result)
@@ -86,9 +141,10 @@ class TestGetWikipediaPage(unittest.TestCase):
     '''Tests for the get_wikipedia_page tool.'''
 
 
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
 
-        self.page_content = get_wikipedia_page('Mercedes Sosa')
+        cls.page_content = _RESULTS['get_wikipedia_page'].result()
 
 
     def test_page_content_type(self):
@@ -103,25 +159,86 @@ class TestGetWikipediaPage(unittest.TestCase):
         self.assertTrue(len(self.page_content) > 0)
 
 
+class TestResultDescription(unittest.TestCase):
+    '''Tests for finding the description in a LibreTexts search result.'''
+
+    def _description(self, html: str, title: str = None) -> str:
+        '''Returns the description of the result with id "result" in html.'''
+
+        result = LexborHTMLParser(html).css_first('#result')
+
+        return _result_description(result, title)
+
+    def test_first_in_document_order(self):
+        '''The outermost long enough element should win over the ones inside it.'''
+        description = self._description(
+            '<div id="result"><div>Outer description text <span>and inner</span></div>' +
+            '<p>A later paragraph that is long enough</p></div>'
+        )
+        self.assertEqual(description, 'Outer description textand inner')
+
+    def test_short_subtree_skipped(self):
+        '''Short elements and everything inside them should be passed over.'''
+        description = self._description(
+            '<div id="result"><div><span>Too short</span> <b>also</b></div>' +
+            '<p>The description paragraph of this result</p></div>'
+        )
+        self.assertEqual(description, 'The description paragraph of this result')
+
+    def test_text_nodes_ignored(self):
+        '''Loose text and other tags should not be taken as the description.'''
+        description = self._description(
+            '<div id="result"><a>A link that is long enough to count</a>' +
+            'Loose text that is long enough to count' +
+            '<p>The description paragraph of this result</p></div>'
+        )
+        self.assertEqual(description, 'The description paragraph of this result')
+
+    def test_title_skipped(self):
+        '''An element holding just the title should not be the description.'''
+        description = self._description(
+            '<div id="result"><span>Introductory Chemistry (CK-12)</span>' +
+            '<p>The description paragraph of this result</p></div>',
+            title='Introductory Chemistry (CK-12)'
+        )
+        self.assertEqual(description, 'The description paragraph of this result')
+
+    def test_stops_at_result_boundary(self):
+        '''The search should not run on into the next result.'''
+        description = self._description(
+            '<div><div id="result"><a>Title</a><span><b>Short</b></span></div>' +
+            '<div><p>The description paragraph of the next result</p></div></div>'
+        )
+        self.assertIsNone(description)
+
+    def test_empty_result(self):
+        '''A result with nothing inside should have no description.'''
+        self.assertIsNone(self._description('<div id="result"></div><p>Not part of the result</p>'))
+
+
+@pytest.mark.slow
 class TestLibretextBookSearch(unittest.TestCase):
     '''Tests for the libretext_book_search tool.'''
 
-    def setUp(self):
-        search_query = 'Introductory chemistry ck-12'
-        self.search_results = libretext_book_search(search_query)
+    @classmethod
+    def setUpClass(cls):
+        cls.search_results = libretext_book_search('Introductory chemistry ck-12')
+
+        # Errors come back as a single item list holding the error
+        cls.failed = any('error' in result for result in cls.search_results)
 
     def test_result_type(self):
-        '''Search results should be a dictionary.'''
-        self.assertIsInstance(self.search_results, dict)
+        '''Search results should be a list.'''
+        self.assertIsInstance(self.search_results, list)
 
     def test_no_error(self):
         '''Search results should not contain an error.'''
-        self.assertNotIn('error', self.search_results)
+        self.assertFalse(self.failed)
 
     def test_result_content(self):
         '''Each search result should contain title, url, and description if results found.'''
-        if len(self.search_results) > 0 and 'error' not in self.search_results:
-            for result in self.search_results.values():
+        if len(self.search_results) > 0 and not self.failed:
+            for result in self.search_results:
                 self.assertIsInstance(result, dict)
                 self.assertIn('title', result)
                 self.assertIn('url', result)
@@ -132,29 +249,26 @@ class TestLibretextBookSearch(unittest.TestCase):
 
     def test_first_result_exists(self):
         '''If results are found, the first result should have a meaningful title.'''
-        if len(self.search_results) > 0 and 'error' not in self.search_results:
-            first_result = next(iter(self.search_results.values()))
+        if len(self.search_results) > 0 and not self.failed:
+            first_result = self.search_results[0]
             self.assertTrue(len(first_result['title']) > 3)
 
     def test_result_urls_valid(self):
         '''URLs should be properly formatted if present.'''
-        if len(self.search_results) > 0 and 'error' not in self.search_results:
-            for result in self.search_results.values():
+        if len(self.search_results) > 0 and not self.failed:
+            for result in self.search_results:
                 if result['url']:  # Only test non-empty URLs
-                    self.assertTrue(
-                        result['url'].startswith('http://') or 
-                        result['url'].startswith('https://') or
-                        result['url'].startswith('/')
-                    )
+                    self.assertTrue(result['url'].startswith(('http://', 'https://', '/')))
 
 
+@pytest.mark.slow
 class TestLibretextBookParser(unittest.TestCase):
     '''Tests for the libretext_book_parser tool.'''
 
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
         # Use a known LibreTexts book URL for testing
-        book_url = 'https://chem.libretexts.org/Bookshelves/Introductory_Chemistry/Introductory_Chemistry_(CK-12)'
-        self.parse_results = libretext_book_parser(book_url)
+        cls.parse_results = libretext_book_parser(BOOK_URL)
 
     def test_result_type(self):
         '''Parse results should be a dictionary.'''
@@ -192,20 +306,16 @@ class TestLibretextBookParser(unittest.TestCase):
         if len(self.parse_results) > 0 and 'error' not in self.parse_results:
             for chapter in self.parse_results.values():
                 if chapter['url']:  # Only test non-empty URLs
-                    self.assertTrue(
-                        chapter['url'].startswith('http://') or 
-                        chapter['url'].startswith('https://') or
-                        chapter['url'].startswith('/')
-                    )
+                    self.assertTrue(chapter['url'].startswith(('http://', 'https://', '/')))
 
 
 class TestLibretextChapterParser(unittest.TestCase):
     '''Tests for the libretext_chapter_parser tool.'''
 
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
         # Use a known LibreTexts chapter URL for testing
-        chapter_url = 'https://chem.libretexts.org/Bookshelves/Introductory_Chemistry/Introductory_Chemistry_(CK-12)/01%3A_Introduction_to_Chemistry'
-        self.parse_results = libretext_chapter_parser(chapter_url)
+        cls.parse_results = _RESULTS['libretext_chapter_parser'].result()
 
     def test_result_type(self):
         '''Parse results should be a dictionary.'''
@@ -243,11 +353,7 @@ class TestLibretextChapterParser(unittest.TestCase):
         if len(self.parse_results) > 0 and 'error' not in self.parse_results:
             for section in self.parse_results.values():
                 if section['url']:  # Only test non-empty URLs
-                    self.assertTrue(
-                        section['url'].startswith('http://') or 
-                        section['url'].startswith('https://') or
-                        section['url'].startswith('/')
-                    )
+                    self.assertTrue(section['url'].startswith(('http://', 'https://', '/')))
 
     def test_sections_have_descriptions(self):
         '''Most sections should have meaningful descriptions.'''
@@ -263,14 +369,14 @@ class TestLibretextChapterParser(unittest.TestCase):
 class TestGetLibretextBook(unittest.TestCase):
     '''Tests for the get_libretext_book tool.'''
 
-    def setUp(self):
-        # Use a smaller LibreTexts book for testing to avoid long test times
-        # This is a smaller book that should have fewer chapters
-        book_url = 'https://chem.libretexts.org/Bookshelves/Introductory_Chemistry/Introductory_Chemistry_(CK-12)'
+    @classmethod
+    def setUpClass(cls):
+        # Serve the book and its chapters from saved pages rather than the live site,
+        # crawling the whole book made this the slowest test by far
+        with mock.patch.object(SESSION, 'get', side_effect=_fixture_get), \
+            mock.patch('functions.tools.save_libretext_book_as_markdown'):
 
-        # For testing, we'll limit to just the first chapter to keep test times reasonable
-        # In a real scenario, you'd process the full book
-        self.book_results = get_libretext_book(book_url)
+            cls.book_results = get_libretext_book(BOOK_URL)
 
     def test_result_type(self):
         '''Book results should be a dictionary.'''
@@ -330,5 +436,12 @@ class TestGetLibretextBook(unittest.TestCase):
                 for chapter_title in self.book_results['chapters'].keys():
                     self.assertTrue(len(chapter_title) > 2)
 
+    def test_fixture_content(self):
+        '''Book should contain every chapter and section from the saved pages.'''
+        self.assertEqual(len(self.book_results['chapters']), 2)
+
+        for chapter in self.book_results['chapters'].values():
+            self.assertEqual(len(chapter['sections']), 2)
+
 if __name__ == '__main__':
     unittest.main()